@@ -3,6 +3,7 @@ import json
 import logging
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from typing import Dict, List, Optional
 import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -19,6 +20,7 @@ MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
 MQTT_TOPIC = os.getenv("MQTT_TOPIC", "autofeed/control")
 MQTT_USERNAME = os.getenv("MQTT_USERNAME")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # Enables /admin/* endpoints when set
 
 # Logging setup
 logging.basicConfig(level=logging.INFO)
@@ -38,21 +40,513 @@ app.add_middleware(
 )
 
 from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+
+# Diagnostics Setup (slow-request capture, sampling profiler, thread CPU)
+import sys
+import time
+import asyncio
+import functools
+import threading
+import contextvars
+from fastapi.routing import APIRoute
+from collections import Counter, deque
+from contextlib import contextmanager
+
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", 1000))  # 0 disables capture
+SLOW_REQUEST_LOG_SIZE = int(os.getenv("SLOW_REQUEST_LOG_SIZE", 50))
+SLOW_SAMPLE_INTERVAL = 0.05  # Watchdog tick (seconds)
+SLOW_MAX_SAMPLES = 200       # Stack samples kept per slow request
+
+# Per-request context: start time, phase timings and the threads currently running its route
+_request_ctx = contextvars.ContextVar("request_ctx", default=None)
+_inflight_requests = {}
+_samples_lock = threading.Lock()  # Watchdog vs. middleware access to ctx["samples"]
+slow_requests = deque(maxlen=SLOW_REQUEST_LOG_SIZE)
+
+def exclude_from_slow_log():
+    """
+    Opts the current request out of slow-request capture. For endpoints that are
+    slow by design (long-polls, profiling) and would otherwise flood the log.
+    """
+    ctx = _request_ctx.get()
+    if ctx is not None:
+        ctx["exclude"] = True
+
+@contextmanager
+def timed_phase(name):
+    """
+    Attributes the wall time of the wrapped block to `name` on the current request.
+    No-op outside a request (e.g. scheduler jobs).
+    """
+    ctx = _request_ctx.get()
+    if ctx is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        ctx["phases"][name] = ctx["phases"].get(name, 0) + elapsed
+
+def _frame_label(frame):
+    code = frame.f_code
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+def _stack_labels(frame):
+    # Root -> leaf, in pstats key format (filename, lineno, funcname)
+    stack = []
+    while frame is not None:
+        stack.append(_frame_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+def _collapse(stack, prefix=None):
+    parts = [prefix] if prefix else []
+    parts += [f"{func} ({os.path.basename(filename)}:{lineno})" for filename, lineno, func in stack]
+    return ";".join(parts)
+
+def _slow_request_watchdog():
+    # Only samples requests that are already over the threshold, so the
+    # steady-state cost is one dict scan per tick.
+    while True:
+        time.sleep(SLOW_SAMPLE_INTERVAL)
+        if not _inflight_requests:
+            continue
+        try:
+            _sample_slow_requests()
+        except Exception as e:
+            logger.error(f"Slow request watchdog error: {e}")
+
+def _sample_slow_requests():
+    now = time.perf_counter()
+    frames = None
+    for ctx in list(_inflight_requests.values()):
+        if ctx["exclude"] or (now - ctx["start"]) * 1000 < SLOW_REQUEST_MS:
+            continue
+        if frames is None:
+            frames = sys._current_frames()
+        with _samples_lock:
+            threads = list(ctx["threads"])
+        stacks = [_stack_labels(frames[ident]) for ident in threads if ident in frames]
+        with _samples_lock:
+            # The middleware marks the ctx done before reading its samples
+            if ctx["done"] or sum(ctx["samples"].values()) >= SLOW_MAX_SAMPLES:
+                continue
+            for stack in stacks:
+                ctx["samples"][stack] += 1
+
+def _record_slow_request(ctx, status_code):
+    duration_ms = (time.perf_counter() - ctx["start"]) * 1000
+    if ctx["exclude"] or duration_ms < SLOW_REQUEST_MS:
+        return
+    phases = {name: round(ms, 2) for name, ms in ctx["phases"].items()}
+    phases["other"] = round(max(0, duration_ms - sum(ctx["phases"].values())), 2)
+    entry = {
+        "timestamp": str(datetime.now()),
+        "method": ctx["method"],
+        "path": ctx["path"],
+        "status": status_code,
+        "duration_ms": round(duration_ms, 2),
+        "phases_ms": phases,
+        "stacks": [
+            {"stack": _collapse(stack), "samples": count}
+            for stack, count in ctx["samples"].most_common(10)
+        ]
+    }
+    slow_requests.append(entry)
+    logger.warning(f"🐢 Slow Request: {ctx['method']} {ctx['path']} took {entry['duration_ms']}ms {phases}")
+
+if SLOW_REQUEST_MS > 0:
+    threading.Thread(target=_slow_request_watchdog, name="slow-request-watchdog", daemon=True).start()
+
+@contextmanager
+def _track_thread():
+    # Registers the calling thread as running the current request's route
+    ctx = _request_ctx.get()
+    if ctx is None:
+        yield
+        return
+    ident = threading.get_ident()
+    with _samples_lock:
+        ctx["threads"].add(ident)
+    try:
+        yield
+    finally:
+        with _samples_lock:
+            ctx["threads"].discard(ident)
+
+def _track_endpoint(endpoint):
+    """
+    Wraps a route so the thread actually executing it is sampled: the
+    threadpool worker for `def` routes, the event loop for `async def` routes.
+    """
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def tracked(*args, **kwargs):
+            with _track_thread():
+                return await endpoint(*args, **kwargs)
+    else:
+        @functools.wraps(endpoint)
+        def tracked(*args, **kwargs):
+            with _track_thread():
+                return endpoint(*args, **kwargs)
+    return tracked
+
+class TrackedRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, _track_endpoint(endpoint), **kwargs)
+
+# Must be set before any route is declared
+app.router.route_class = TrackedRoute
 
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     logger.info(f"➡️ Incoming Request: {request.method} {request.url}")
+    request_id = uuid.uuid4().hex
+    ctx = {
+        "method": request.method,
+        "path": request.url.path,
+        "start": time.perf_counter(),
+        "phases": {},
+        "threads": set(),
+        "samples": Counter(),
+        "exclude": False,
+        "done": False
+    }
+    token = _request_ctx.set(ctx)
+    _inflight_requests[request_id] = ctx
+    status_code = 500
     try:
         response = await call_next(request)
+        status_code = response.status_code
         logger.info(f"⬅️ Response: {response.status_code}")
         return response
     except Exception as e:
         logger.error(f"❌ Request Failed: {e}")
         raise e
+    finally:
+        _inflight_requests.pop(request_id, None)
+        _request_ctx.reset(token)
+        with _samples_lock:
+            ctx["done"] = True
+        if SLOW_REQUEST_MS > 0:
+            _record_slow_request(ctx, status_code)
 
 # Global state for devices
 device_states = {}
 
+# Admission Control for control endpoints (/feed, /water, scheduled feeds)
+import math
+
+COMMAND_RATE_PER_MIN = float(os.getenv("COMMAND_RATE_PER_MIN", 6))  # Per device
+COMMAND_BURST = int(os.getenv("COMMAND_BURST", 3))
+GLOBAL_COMMAND_RATE = float(os.getenv("GLOBAL_COMMAND_RATE", 20))  # Per second, all devices
+MAX_CONCURRENT_COMMANDS = int(os.getenv("MAX_CONCURRENT_COMMANDS", 16))
+COMMAND_QUEUE_SIZE = int(os.getenv("COMMAND_QUEUE_SIZE", 3))  # Pending dispenses per device
+DISPENSE_TIMEOUT = 75  # Firmware gives up after 60s; free a silent device after this
+IDLE_GRACE = 5         # Ignore periodic "Idle" right after dispatch (command still in flight)
+QUEUE_RETRY_AFTER = 10
+
+DISPENSE_DONE_STATUSES = {"Feeding completed", "Feeding timeout", "Target reached", "Water dispensed"}
+
+class TokenBucket:
+    """
+    Token bucket refilled lazily on each take. Guarded by admission_lock.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """
+        Takes a token. Returns 0 on success, otherwise seconds until one is available.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+admission_lock = threading.Lock()
+command_slots = threading.BoundedSemaphore(MAX_CONCURRENT_COMMANDS)
+global_bucket = TokenBucket(GLOBAL_COMMAND_RATE, max(1, int(GLOBAL_COMMAND_RATE)))
+device_buckets = {}
+# device_id -> {"busy_since": monotonic time of last dispatch or None, "pending": deque of payloads}
+command_queues = {}
+
+def too_many_requests(detail, retry_after):
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+@contextmanager
+def command_slot():
+    """
+    Global cap on control requests being processed at once.
+    """
+    if not command_slots.acquire(blocking=False):
+        raise too_many_requests("Too many concurrent commands", 1)
+    try:
+        yield
+    finally:
+        command_slots.release()
+
+def _take_tokens(device_id, now):
+    # Lock held. Raises 429 without consuming anything if either bucket is empty.
+    wait = global_bucket.take(now)
+    if wait:
+        raise too_many_requests("Command rate limit exceeded", wait)
+    bucket = device_buckets.get(device_id)
+    if bucket is None:
+        bucket = device_buckets[device_id] = TokenBucket(COMMAND_RATE_PER_MIN / 60, COMMAND_BURST)
+    wait = bucket.take(now)
+    if wait:
+        global_bucket.refund()  # The command was not admitted
+        raise too_many_requests(f"Too many commands for {device_id}", wait)
+
+def publish_command(device_id, payload):
+    topic = f"feeder/{device_id}/control"
+    with timed_phase("mqtt_publish"):
+        mqtt_client.publish(topic, json.dumps(payload))
+    logger.info(f"Published to {topic}: {payload}")
+
+def _get_queue(device_id):
+    # Lock held
+    queue = command_queues.get(device_id)
+    if queue is None:
+        queue = command_queues[device_id] = {"busy_since": None, "pending": deque()}
+    return queue
+
+def _release_device(queue, now):
+    # Lock held. Frees the device, or hands it straight to the next queued command.
+    if queue["pending"]:
+        queue["busy_since"] = now
+        return queue["pending"].popleft()
+    queue["busy_since"] = None
+    return None
+
+def _is_dispensing(status_msg):
+    # "Feeding started", "Feeding... 12g", "Dispensing water..."
+    return status_msg not in DISPENSE_DONE_STATUSES and status_msg.startswith(("Feeding", "Dispensing"))
+
+def _status_state(status_msg):
+    # Collapses the dispensing progress messages into one state
+    return "dispensing" if _is_dispensing(status_msg) else status_msg
+
+def submit_command(device_id, payload, limit=True):
+    """
+    Publishes now if the device is free, otherwise queues behind the dispense
+    in progress. Returns the queue position (0 = sent immediately).
+    With `limit`, enforces the queue size and rate limits; rate tokens are only
+    taken once the command is known to fit in the queue.
+    """
+    now = time.monotonic()
+    with admission_lock:
+        queue = _get_queue(device_id)
+        if limit:
+            if queue["busy_since"] is not None and len(queue["pending"]) >= COMMAND_QUEUE_SIZE:
+                raise too_many_requests(f"Device {device_id} is busy, command queue full", QUEUE_RETRY_AFTER)
+            _take_tokens(device_id, now)
+        if queue["busy_since"] is not None:
+            queue["pending"].append(payload)
+            return len(queue["pending"])
+        queue["busy_since"] = now
+
+    try:
+        publish_command(device_id, payload)
+    except Exception:
+        with admission_lock:
+            if not queue["pending"]:
+                queue["busy_since"] = None
+        raise
+    return 0
+
+def _dispatch_next(device_id, payload):
+    try:
+        publish_command(device_id, payload)
+    except Exception as e:
+        logger.error(f"Failed to dispatch queued command for {device_id}: {e}")
+
+def on_device_status(device_id, status_msg):
+    """
+    Advances the device's command queue from its reported status.
+    """
+    now = time.monotonic()
+    next_payload = None
+    with admission_lock:
+        if _is_dispensing(status_msg):
+            # Also covers dispenses we did not start (e.g. the device's own button)
+            queue = _get_queue(device_id)
+            if queue["busy_since"] is None:
+                queue["busy_since"] = now
+        else:
+            queue = command_queues.get(device_id)
+            if queue is None or queue["busy_since"] is None:
+                return
+            if status_msg in DISPENSE_DONE_STATUSES or (status_msg == "Idle" and now - queue["busy_since"] > IDLE_GRACE):
+                next_payload = _release_device(queue, now)
+    if next_payload:
+        _dispatch_next(device_id, next_payload)
+
+def release_stale_devices():
+    """
+    Frees devices that never reported completion (offline, lost message), and
+    drops bookkeeping for idle devices so client-chosen ids cannot grow it forever.
+    """
+    now = time.monotonic()
+    to_dispatch = []
+    with admission_lock:
+        for device_id, queue in list(command_queues.items()):
+            if queue["busy_since"] is not None and now - queue["busy_since"] > DISPENSE_TIMEOUT:
+                logger.warning(f"⌛ No completion from {device_id} after {DISPENSE_TIMEOUT}s, releasing")
+                next_payload = _release_device(queue, now)
+                if next_payload:
+                    to_dispatch.append((device_id, next_payload))
+            elif queue["busy_since"] is None and not queue["pending"]:
+                del command_queues[device_id]
+        # A full bucket behaves exactly like a new one, so it is safe to forget
+        for device_id, bucket in list(device_buckets.items()):
+            if bucket.is_full(now):
+                del device_buckets[device_id]
+    for device_id, payload in to_dispatch:
+        _dispatch_next(device_id, payload)
+
+# Event Log (ordered change-data feed served by GET /events)
+import bisect
+
+EVENTS_FILE = "events.jsonl"
+# Retention: only the newest EVENT_BUFFER_SIZE events are kept, in memory and
+# on disk. The first line of the file holds the log's epoch, a random id that
+# changes whenever the log starts over (e.g. lost on an ephemeral filesystem),
+# so consumers can tell their offsets no longer apply.
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", 5000))
+
+events_lock = threading.Lock()
+event_buffer = deque(maxlen=EVENT_BUFFER_SIZE)
+event_offsets = deque(maxlen=EVENT_BUFFER_SIZE)  # Parallel to event_buffer, for bisect
+event_waiters = set()  # (loop, asyncio.Event) for pending long-polls
+event_epoch = None
+next_event_offset = 1
+event_file_lines = 0
+
+def _compact_events():
+    # Lock held. Rewrites the log with the epoch header and just the retained events.
+    global event_file_lines
+    tmp_file = EVENTS_FILE + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write(json.dumps({"epoch": event_epoch}) + "\n")
+        for event in event_buffer:
+            f.write(json.dumps(event) + "\n")
+    os.replace(tmp_file, EVENTS_FILE)
+    event_file_lines = len(event_buffer)
+
+def _buffer_event(event):
+    event_buffer.append(event)
+    event_offsets.append(event["offset"])
+
+def load_events():
+    """
+    Restores the epoch, the retained events and the next offset from the log.
+    Lines cut short by a crash are skipped and the log is rewritten; their
+    offsets are never handed out again, since consumers may have seen them.
+    """
+    global event_epoch, next_event_offset, event_file_lines
+    corrupt = 0
+    if os.path.exists(EVENTS_FILE):
+        with open(EVENTS_FILE, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    corrupt += 1
+                    logger.warning(f"Skipping unreadable event line: {line[:80]!r}")
+                    continue
+                if "offset" not in record:
+                    event_epoch = record.get("epoch")
+                    continue
+                event_file_lines += 1
+                _buffer_event(record)
+    if event_buffer:
+        next_event_offset = event_buffer[-1]["offset"] + 1
+    next_event_offset += corrupt
+
+    new_epoch = event_epoch is None
+    if new_epoch:
+        event_epoch = uuid.uuid4().hex
+        logger.info(f"Starting event log epoch {event_epoch}")
+    if new_epoch or corrupt or event_file_lines > EVENT_BUFFER_SIZE:
+        try:
+            _compact_events()
+        except Exception as e:
+            logger.error(f"Error compacting events: {e}")
+
+def append_event(event_type, device_id=None, data=None):
+    """
+    Appends an event with the next offset and wakes any waiting long-polls.
+    Safe to call from any thread (request workers, paho loop, scheduler).
+    """
+    global next_event_offset, event_file_lines
+    with events_lock:
+        event = {
+            "offset": next_event_offset,
+            "timestamp": str(datetime.now()),
+            "type": event_type,
+            "device_id": device_id,
+            "data": data or {}
+        }
+        next_event_offset += 1
+        _buffer_event(event)
+        try:
+            # Compacting at 2x retention keeps the file bounded at amortized O(1) per event
+            if event_file_lines >= 2 * EVENT_BUFFER_SIZE:
+                _compact_events()
+            else:
+                with open(EVENTS_FILE, "a") as f:
+                    f.write(json.dumps(event) + "\n")
+                event_file_lines += 1
+        except Exception as e:
+            logger.error(f"Error saving event: {e}")
+        waiters = list(event_waiters)
+
+    for loop, waiter in waiters:
+        loop.call_soon_threadsafe(waiter.set)
+    return event
+
+def read_events(after, limit):
+    """
+    Returns (events with offset > `after`, up to `limit`; oldest retained offset).
+    Always served from memory; offsets may have gaps, so the start is found by
+    bisect rather than position. The event list is None when `after` is outside
+    the log (older than retention, or ahead of it after a reset) and the
+    consumer must resync.
+    """
+    with events_lock:
+        oldest = event_offsets[0] if event_offsets else next_event_offset
+        if after + 1 < oldest or after >= next_event_offset:
+            return None, oldest
+        start = bisect.bisect_right(event_offsets, after)
+        return [event_buffer[i] for i in range(start, min(start + limit, len(event_buffer)))], oldest
+
+load_events()
+
 # MQTT Client setup
 mqtt_client = mqtt.Client()
 
@@ -92,6 +586,12 @@ def on_message(client, userdata, msg):
                 "status": status_msg,
                 "last_seen": str(datetime.now())
             }
+            on_device_status(device_id, status_msg)
+            
+            # Only changes go to the event log, not heartbeats or "Feeding... Ng" progress ticks
+            previous_status = existing_state.get("status", "")
+            if _status_state(status_msg) != _status_state(previous_status) or not existing_state.get("online"):
+                append_event("status", device_id, {"status": status_msg, "weight": current_weight})
             
             if status_msg == "Feeding completed":
                 # Optimistic update is now handled in /feed and scheduled_feed_job
@@ -130,6 +630,7 @@ import tzlocal
 local_tz = tzlocal.get_localzone()
 scheduler = BackgroundScheduler(timezone=local_tz)
 scheduler.start()
+scheduler.add_job(release_stale_devices, "interval", seconds=10, id="release-stale-devices", replace_existing=True)
 
 SCHEDULE_FILE = "schedules.json"
 
@@ -146,42 +647,77 @@ def save_schedules(schedules):
     with open(SCHEDULE_FILE, "w") as f:
         json.dump(schedules, f, indent=2)
 
-def scheduled_feed_job(device_id, amount, unit):
-    logger.info(f"⏰ Executing Scheduled Feed for {device_id}: {amount}{unit}")
-    
+def dispatch_scheduled_feeds(feeds):
+    """
+    Optimistic container/history updates and MQTT dispatch for a batch of
+    (device_id, amount, unit) feeds. History is rewritten once per batch.
+    """
     # 1. Optimistic Storage Update
-    current_state = device_states.get(device_id, {})
-    current_container = current_state.get("container_weight", 500)
-    new_container = max(0, current_container - amount)
-    
-    # Update state (create if not exists)
-    if device_id not in device_states:
-        device_states[device_id] = {}
-    device_states[device_id]["container_weight"] = new_container
+    for device_id, amount, unit in feeds:
+        current_state = device_states.get(device_id, {})
+        current_container = current_state.get("container_weight", 500)
+        new_container = max(0, current_container - amount)
+        
+        # Update state (create if not exists)
+        if device_id not in device_states:
+            device_states[device_id] = {}
+        device_states[device_id]["container_weight"] = new_container
     
     # 2. Optimistic History Log
+    fed_at = datetime.now()
     history = load_history()
-    history.append({
-        "timestamp": str(datetime.now()),
-        "device_id": device_id,
-        "amount": amount,
-        "unit": unit,
-        "source": "schedule"
-    })
+    for device_id, amount, unit in feeds:
+        history.append({
+            "timestamp": str(fed_at),
+            "device_id": device_id,
+            "amount": amount,
+            "unit": unit,
+            "source": "schedule"
+        })
     save_history(history)
+    for device_id, amount, unit in feeds:
+        record_feed_summary(device_id, amount, unit, "schedule", fed_at)
     
-    # 3. Send MQTT Command
-    topic = f"feeder/{device_id}/control"
-    payload = {
-        "cmd": "feed",
-        "amount": amount,
-        "unit": unit
-    }
-    try:
-        mqtt_client.publish(topic, json.dumps(payload))
-        logger.info(f"✅ Scheduled Feed Published to {topic}")
-    except Exception as e:
-        logger.error(f"Failed to execute scheduled feed: {e}")
+    # 3. Send MQTT Commands (serialized behind any dispense in progress, never rate limited)
+    for device_id, amount, unit in feeds:
+        append_event("feed", device_id, {"amount": amount, "unit": unit, "source": "schedule"})
+        payload = {
+            "cmd": "feed",
+            "amount": amount,
+            "unit": unit
+        }
+        try:
+            position = submit_command(device_id, payload, limit=False)
+            if position:
+                logger.info(f"⏳ Scheduled Feed queued for {device_id} (position {position})")
+            else:
+                logger.info(f"✅ Scheduled Feed Published for {device_id}")
+        except Exception as e:
+            logger.error(f"Failed to execute scheduled feed for {device_id}: {e}")
+
+def scheduled_feed_job(device_id, amount, unit):
+    logger.info(f"⏰ Executing Scheduled Feed for {device_id}: {amount}{unit}")
+    dispatch_scheduled_feeds([(device_id, amount, unit)])
+
+# In-memory schedule registry, indexed by device, so reads never touch the file
+schedule_lock = threading.Lock()  # Guards the registry and writes to schedules.json
+schedule_registry = {}    # id -> schedule
+schedules_by_device = {}  # device_id -> {id: schedule}
+
+def register_schedule(schedule):
+    # schedule_lock held (except during startup restore)
+    schedule_registry[schedule["id"]] = schedule
+    schedules_by_device.setdefault(schedule["device_id"], {})[schedule["id"]] = schedule
+
+def unregister_schedule(job_id):
+    # schedule_lock held
+    schedule = schedule_registry.pop(job_id, None)
+    if schedule:
+        device_schedules = schedules_by_device.get(schedule["device_id"], {})
+        device_schedules.pop(job_id, None)
+        if not device_schedules:
+            schedules_by_device.pop(schedule["device_id"], None)
+    return schedule
 
 # Restore schedules on startup
 active_schedules = load_schedules()
@@ -196,8 +732,202 @@ for s in active_schedules:
         args=[s['device_id'], s['amount'], s['unit']],
         replace_existing=True
     )
+    register_schedule(s)
     logger.info(f"Restored schedule: {s['time']} - {s['amount']}g")
 
+# Fleet Schedules: meal plan templates attached to device groups.
+# A template is stored once; it is expanded into per-device feeds only when
+# one of its meal times fires, with one scheduler job per distinct time.
+FLEET_FILE = "fleet.json"
+
+fleet_lock = threading.Lock()
+fleet = {"templates": {}, "groups": {}, "overrides": {}}
+device_group = {}        # device_id -> group_id (a device is in at most one group)
+meals_by_time = {}       # "HH:MM" -> [(template_id, meal)]
+groups_by_template = {}  # template_id -> [group_id]
+
+def normalize_time(value):
+    hour, minute = map(int, value.split(':'))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"Invalid time {value}. Use HH:MM")
+    return f"{hour:02d}:{minute:02d}"
+
+def load_fleet():
+    if os.path.exists(FLEET_FILE):
+        try:
+            with open(FLEET_FILE, "r") as f:
+                data = json.load(f)
+            fleet["templates"] = {t["id"]: t for t in data.get("templates", [])}
+            fleet["groups"] = {g["id"]: g for g in data.get("groups", [])}
+            fleet["overrides"] = data.get("overrides", {})
+        except Exception as e:
+            logger.error(f"Error loading fleet schedules: {e}")
+
+def save_fleet():
+    with open(FLEET_FILE, "w") as f:
+        json.dump(export_fleet(), f, indent=2)
+
+def export_fleet():
+    return {
+        "templates": list(fleet["templates"].values()),
+        "groups": list(fleet["groups"].values()),
+        "overrides": fleet["overrides"]
+    }
+
+def rebuild_fleet_index():
+    # fleet_lock held. Mutations are rare, so indexes are simply rebuilt.
+    device_group.clear()
+    meals_by_time.clear()
+    groups_by_template.clear()
+    for template in fleet["templates"].values():
+        for meal in template["meals"]:
+            meals_by_time.setdefault(meal["time"], []).append((template["id"], meal))
+    for group in fleet["groups"].values():
+        groups_by_template.setdefault(group["template_id"], []).append(group["id"])
+        for device_id in group["device_ids"]:
+            device_group[device_id] = group["id"]
+    prune_overrides()
+    sync_fleet_jobs()
+
+def prune_overrides():
+    """
+    Drops override times that no longer match the device's current group plan
+    (template replaced, device removed from its group or group deleted), so an
+    override never silently stops applying or applies to a different plan.
+    """
+    # fleet_lock held, indexes rebuilt
+    for device_id, override in list(fleet["overrides"].items()):
+        group = fleet["groups"].get(device_group.get(device_id))
+        stale = unmatched_override_times(override, group, fleet["templates"])
+        if not stale:
+            continue
+        logger.warning(f"Dropping overrides for {device_id} that match no meal in its plan: {', '.join(stale)}")
+        for time_str in stale:
+            del override[time_str]
+        if not override:
+            del fleet["overrides"][device_id]
+
+def sync_fleet_jobs():
+    wanted = {f"fleet-{time_str}": time_str for time_str in meals_by_time}
+    for job in scheduler.get_jobs():
+        if job.id.startswith("fleet-") and job.id not in wanted:
+            job.remove()
+    for job_id, time_str in wanted.items():
+        if scheduler.get_job(job_id) is None:
+            hour, minute = map(int, time_str.split(':'))
+            scheduler.add_job(
+                fleet_meal_job,
+                CronTrigger(hour=hour, minute=minute, timezone=local_tz),
+                id=job_id,
+                args=[time_str]
+            )
+            logger.info(f"📅 Fleet meal job at {time_str}")
+
+def resolve_meal(device_id, meal):
+    """
+    Applies the device's override to a template meal.
+    Returns (amount, unit), or None if the device skips this meal.
+    """
+    override = fleet["overrides"].get(device_id, {}).get(meal["time"])
+    if not override:
+        return meal["amount"], meal["unit"]
+    if override.get("skip"):
+        return None
+    return override.get("amount") or meal["amount"], override.get("unit") or meal["unit"]
+
+def expand_meal(time_str):
+    # fleet_lock held
+    feeds = []
+    for template_id, meal in meals_by_time.get(time_str, []):
+        for group_id in groups_by_template.get(template_id, []):
+            for device_id in fleet["groups"][group_id]["device_ids"]:
+                resolved = resolve_meal(device_id, meal)
+                if resolved:
+                    feeds.append((device_id, *resolved))
+    return feeds
+
+def fleet_meal_job(time_str):
+    with fleet_lock:
+        feeds = expand_meal(time_str)
+    if feeds:
+        logger.info(f"⏰ Executing Fleet Meal {time_str} for {len(feeds)} feeders")
+        dispatch_scheduled_feeds(feeds)
+
+def device_schedules(device_id):
+    """
+    Effective schedules for one device: its own entries plus its group's template.
+    """
+    with schedule_lock:
+        schedules = [dict(s, source="device") for s in schedules_by_device.get(device_id, {}).values()]
+    with fleet_lock:
+        group_id = device_group.get(device_id)
+        if group_id:
+            group = fleet["groups"][group_id]
+            template = fleet["templates"][group["template_id"]]
+            for meal in template["meals"]:
+                resolved = resolve_meal(device_id, meal)
+                schedules.append({
+                    "id": f"{template['id']}:{meal['time']}",
+                    "device_id": device_id,
+                    "time": meal["time"],
+                    "amount": resolved[0] if resolved else meal["amount"],
+                    "unit": resolved[1] if resolved else meal["unit"],
+                    "source": "template",
+                    "template_id": template["id"],
+                    "group_id": group_id,
+                    "skipped": resolved is None
+                })
+    schedules.sort(key=lambda x: tuple(map(int, x["time"].split(':'))))
+    return schedules
+
+def build_template(template_id, name, meals):
+    normalized = {}
+    for meal in meals:
+        time_str = normalize_time(meal.time)
+        if time_str in normalized:
+            raise ValueError(f"Duplicate meal time {time_str}")
+        if meal.amount <= 0:
+            raise ValueError("Amount must be positive")
+        normalized[time_str] = {"time": time_str, "amount": meal.amount, "unit": meal.unit}
+    return {"id": template_id, "name": name, "meals": [normalized[t] for t in sorted(normalized)]}
+
+def build_override(meals):
+    override = {}
+    for time_str, meal in meals.items():
+        if meal.amount is not None and meal.amount <= 0:
+            raise ValueError("Amount must be positive")
+        entry = {"skip": meal.skip}
+        if meal.amount is not None:
+            entry["amount"] = meal.amount
+        if meal.unit is not None:
+            entry["unit"] = meal.unit
+        override[normalize_time(time_str)] = entry
+    return override
+
+def unmatched_override_times(override, group, templates):
+    """
+    Override times that match no meal in the group's template (all of them if
+    the device is in no group), so they can be rejected instead of never applying.
+    """
+    meal_times = {meal["time"] for meal in templates[group["template_id"]]["meals"]} if group else set()
+    return sorted(t for t in override if t not in meal_times)
+
+def assign_devices(groups, group, device_ids, overrides):
+    # fleet_lock held. Moves devices out of any other group; their overrides were
+    # made for the old plan, so they are dropped rather than carried over.
+    moved = set(device_ids)
+    for other in groups.values():
+        if other["id"] != group["id"]:
+            leaving = moved.intersection(other["device_ids"])
+            for device_id in leaving:
+                overrides.pop(device_id, None)
+            other["device_ids"] = [d for d in other["device_ids"] if d not in moved]
+    group["device_ids"] = list(dict.fromkeys(group["device_ids"] + list(device_ids)))
+
+with fleet_lock:
+    load_fleet()
+    rebuild_fleet_index()
+
 # Gemini AI Setup
 import google.generativeai as genai
 
@@ -241,6 +971,7 @@ class WaterRequest(BaseModel):
 class ChatRequest(BaseModel):
     message: str
     context: str = ""
+    device_id: Optional[str] = None # Adds the feeder's feeding summary to the prompt
 
 class DietRequest(BaseModel):
     pet_name: str
@@ -248,6 +979,7 @@ class DietRequest(BaseModel):
     breed: str = ""
     weight: float
     age: float
+    device_id: Optional[str] = None
 
 class ScheduleRequest(BaseModel):
     device_id: str
@@ -255,6 +987,40 @@ class ScheduleRequest(BaseModel):
     amount: int
     unit: str = "g"
 
+class MealSlot(BaseModel):
+    time: str # HH:MM (24h format)
+    amount: int
+    unit: str = "g"
+
+class TemplateRequest(BaseModel):
+    name: str
+    meals: List[MealSlot]
+
+class GroupRequest(BaseModel):
+    name: str
+    template_id: str
+    device_ids: List[str] = []
+
+class GroupDevicesRequest(BaseModel):
+    device_ids: List[str]
+
+class MealOverride(BaseModel):
+    amount: Optional[int] = None
+    unit: Optional[str] = None
+    skip: bool = False
+
+class TemplateImport(TemplateRequest):
+    id: Optional[str] = None
+
+class GroupImport(GroupRequest):
+    id: Optional[str] = None
+
+class FleetImportRequest(BaseModel):
+    templates: List[TemplateImport] = []
+    groups: List[GroupImport] = []
+    overrides: Dict[str, Dict[str, MealOverride]] = {}
+    replace: bool = False # Replace the whole fleet instead of merging by id
+
 # Endpoints
 @app.get("/")
 def read_root():
@@ -267,17 +1033,107 @@ def health_check():
 HISTORY_FILE = "history.json"
 
 def load_history():
-    if os.path.exists(HISTORY_FILE):
+    with timed_phase("history_io"):
+        if os.path.exists(HISTORY_FILE):
+            try:
+                with open(HISTORY_FILE, "r") as f:
+                    return json.load(f)
+            except:
+                return []
+        return []
+
+def save_history(history):
+    with timed_phase("history_io"):
+        with open(HISTORY_FILE, "w") as f:
+            json.dump(history, f, indent=2)
+
+# Pet Context Summaries for the AI assistant.
+# Daily aggregates are updated as feeds are recorded, so AI requests read a
+# few precomputed numbers instead of scanning history.json.
+CONTEXT_DAYS = 14
+AI_CONTEXT_TOKENS = int(os.getenv("AI_CONTEXT_TOKENS", 120))
+CHARS_PER_TOKEN = 4  # Rough estimate used to size the injected context
+
+context_lock = threading.Lock()
+pet_summaries = {}  # device_id -> {"daily": {date: {"amount", "feeds", "scheduled"}}, "last_feed": {...}}
+
+def record_feed_summary(device_id, amount, unit, source, timestamp):
+    day = timestamp.date().isoformat()
+    with context_lock:
+        summary = pet_summaries.setdefault(device_id, {"daily": {}, "last_feed": None})
+        daily = summary["daily"].setdefault(day, {"amount": 0, "feeds": 0, "scheduled": 0})
+        daily["amount"] += amount
+        daily["feeds"] += 1
+        if source == "schedule":
+            daily["scheduled"] += 1
+        if summary["last_feed"] is None or timestamp >= summary["last_feed"]["timestamp"]:
+            summary["last_feed"] = {"timestamp": timestamp, "amount": amount, "unit": unit, "source": source}
+        if len(summary["daily"]) > CONTEXT_DAYS:
+            cutoff = (timestamp.date() - timedelta(days=CONTEXT_DAYS)).isoformat()
+            for old_day in [d for d in summary["daily"] if d <= cutoff]:
+                del summary["daily"][old_day]
+
+def load_pet_summaries():
+    """
+    One scan of history.json at startup; afterwards summaries are incremental.
+    """
+    cutoff = datetime.now().date() - timedelta(days=CONTEXT_DAYS)
+    for entry in load_history():
         try:
-            with open(HISTORY_FILE, "r") as f:
-                return json.load(f)
+            timestamp = datetime.fromisoformat(entry["timestamp"])
+            if timestamp.date() > cutoff:
+                record_feed_summary(entry["device_id"], entry["amount"], entry.get("unit", "g"), entry.get("source", "manual"), timestamp)
         except:
-            return []
-    return []
+            pass
 
-def save_history(history):
-    with open(HISTORY_FILE, "w") as f:
-        json.dump(history, f, indent=2)
+def pet_context(device_id, max_tokens=AI_CONTEXT_TOKENS):
+    """
+    Compact feeding summary for prompts, most important facts first,
+    cut to fit `max_tokens`. Returns "" if nothing is known about the device.
+    """
+    today = datetime.now().date()
+    with context_lock:
+        summary = pet_summaries.get(device_id)
+        if summary:
+            last_feed = dict(summary["last_feed"])
+            days = [summary["daily"].get((today - timedelta(days=i)).isoformat(), {}) for i in range(CONTEXT_DAYS)]
+    state = device_states.get(device_id, {})
+    if not summary and not state:
+        return ""
+
+    lines = []
+    if summary:
+        ago = datetime.now() - last_feed["timestamp"]
+        hours = int(ago.total_seconds() // 3600)
+        lines.append(f"Last feed {last_feed['amount']}{last_feed['unit']} ({last_feed['source']}) {hours}h ago")
+        lines.append(f"Today {days[0].get('amount', 0)}g in {days[0].get('feeds', 0)} feeds")
+
+        week = sum(d.get("amount", 0) for d in days[:7]) / 7
+        prev_week = sum(d.get("amount", 0) for d in days[7:]) / 7
+        trend = f", prev 7d {prev_week:.0f}g/day ({(week - prev_week) / prev_week * 100:+.0f}%)" if prev_week else ""
+        lines.append(f"Avg last 7d {week:.0f}g/day{trend}")
+
+        planned = [s for s in device_schedules(device_id) if not s.get("skipped")]
+        if planned:
+            scheduled = sum(d.get("scheduled", 0) for d in days[:7])
+            manual = sum(d.get("feeds", 0) - d.get("scheduled", 0) for d in days[:7])
+            lines.append(f"Schedule {len(planned)} meals/day ({sum(s['amount'] for s in planned)}g); "
+                         f"{scheduled}/{len(planned) * 7} scheduled + {manual} manual feeds in 7d")
+    if "container_weight" in state:
+        lines.append(f"Food container {state['container_weight']}g left")
+    if summary:
+        lines.append("Daily g, oldest first: " + ",".join(str(d.get("amount", 0)) for d in reversed(days[:7])))
+
+    budget = max_tokens * CHARS_PER_TOKEN
+    context = ""
+    for line in lines:
+        candidate = f"{context}; {line}" if context else line
+        if len(candidate) > budget:
+            break
+        context = candidate
+    return context
+
+load_pet_summaries()
 
 @app.post("/feed")
 def feed_pet(request: FeedRequest):
@@ -287,43 +1143,52 @@ def feed_pet(request: FeedRequest):
     if request.amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be positive")
 
-    # Dynamic Topic
-    topic = f"feeder/{request.device_id}/control"
-    
     payload = {
         "cmd": "feed",
         "amount": request.amount,
         "unit": request.unit
     }
     
-    try:
-        mqtt_client.publish(topic, json.dumps(payload))
-        logger.info(f"Published to {topic}: {payload}")
-        
-        # Optimistic Update for Manual Feed
-        # Update Container
-        current_state = device_states.get(request.device_id, {})
-        current_container = current_state.get("container_weight", 500)
-        new_container = max(0, current_container - request.amount)
-        
-        if request.device_id not in device_states:
-             device_states[request.device_id] = {}
-        device_states[request.device_id]["container_weight"] = new_container
-        
-        # Save History
-        history = load_history()
-        history.append({
-            "timestamp": str(datetime.now()),
-            "device_id": request.device_id,
-            "amount": request.amount,
-            "unit": request.unit,
-            "source": "manual"
-        })
-        save_history(history)
-        
-        return {"message": f"Feed command sent to {request.device_id}", "data": payload}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail="Failed to communicate with device")
+    with command_slot():
+        try:
+            position = submit_command(request.device_id, payload)
+            
+            # Optimistic Update for Manual Feed
+            # Update Container
+            current_state = device_states.get(request.device_id, {})
+            current_container = current_state.get("container_weight", 500)
+            new_container = max(0, current_container - request.amount)
+            
+            if request.device_id not in device_states:
+                 device_states[request.device_id] = {}
+            device_states[request.device_id]["container_weight"] = new_container
+            
+            # Save History
+            fed_at = datetime.now()
+            history = load_history()
+            history.append({
+                "timestamp": str(fed_at),
+                "device_id": request.device_id,
+                "amount": request.amount,
+                "unit": request.unit,
+                "source": "manual"
+            })
+            save_history(history)
+            record_feed_summary(request.device_id, request.amount, request.unit, "manual", fed_at)
+            append_event("feed", request.device_id, {
+                "amount": request.amount,
+                "unit": request.unit,
+                "source": "manual",
+                "queued": position > 0
+            })
+            
+            if position:
+                return {"message": f"Feed command queued for {request.device_id}", "queue_position": position, "data": payload}
+            return {"message": f"Feed command sent to {request.device_id}", "data": payload}
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail="Failed to communicate with device")
 
 @app.get("/analytics/weekly")
 def get_weekly_analytics():
@@ -362,6 +1227,64 @@ def get_history():
     history.sort(key=lambda x: x["timestamp"], reverse=True)
     return {"history": history}
 
+@app.get("/events")
+async def get_events(after: int = 0, limit: int = 100, timeout: float = 25, epoch: Optional[str] = None):
+    """
+    Returns events with offset > `after`, oldest first. If none are available yet,
+    waits up to `timeout` seconds for new ones (long-poll). Resume with `next_offset`
+    and the returned `epoch`. Returns 410 with `oldest_offset`/`latest_offset` when
+    `after` is outside the log or `epoch` no longer matches (log was reset).
+    """
+    # Idle long-polls are slow by design
+    exclude_from_slow_log()
+    if limit <= 0 or limit > 1000:
+        raise HTTPException(status_code=400, detail="Limit must be between 1 and 1000")
+    if timeout < 0 or timeout > 60:
+        raise HTTPException(status_code=400, detail="Timeout must be between 0 and 60 seconds")
+
+    events, oldest = None, None
+    if epoch is None or epoch == event_epoch:
+        events, oldest = await run_in_threadpool(read_events, after, limit)
+    if events == [] and timeout > 0:
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with events_lock:
+            event_waiters.add(waiter)
+        try:
+            # Re-check after registering so an append in between is not missed
+            events, oldest = await run_in_threadpool(read_events, after, limit)
+            if events == []:
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                events, oldest = await run_in_threadpool(read_events, after, limit)
+        finally:
+            with events_lock:
+                event_waiters.discard(waiter)
+
+    latest = next_event_offset - 1
+    if events is None:
+        if epoch is not None and epoch != event_epoch:
+            message = "Event log was reset"
+        elif after > latest:
+            message = "Offset is ahead of the log"
+        else:
+            message = "Offset expired"
+        raise HTTPException(status_code=410, detail={
+            "message": message,
+            "epoch": event_epoch,
+            "oldest_offset": event_offsets[0] if event_offsets else next_event_offset,
+            "latest_offset": latest
+        })
+
+    return {
+        "events": events,
+        "epoch": event_epoch,
+        "next_offset": events[-1]["offset"] if events else after,
+        "oldest_offset": oldest,
+        "latest_offset": latest
+    }
+
 @app.get("/device/{device_id}/status")
 def get_device_status(device_id: str):
     """
@@ -379,6 +1302,13 @@ def get_device_status(device_id: str):
         }
     return status
 
+@app.get("/device/{device_id}/context")
+def get_device_context(device_id: str):
+    """
+    The feeding summary the AI assistant sees for this device.
+    """
+    return {"context": pet_context(device_id)}
+
 @app.post("/device/{device_id}/refill")
 def refill_container(device_id: str):
     """
@@ -395,6 +1325,7 @@ def refill_container(device_id: str):
         **current_state,
         "container_weight": 500
     }
+    append_event("refill", device_id, {"container_weight": 500})
     
     return {"message": "Container refilled", "container_weight": 500}
 
@@ -406,22 +1337,28 @@ def dispense_water(request: WaterRequest):
     if request.amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be positive")
 
-    # Dynamic Topic
-    topic = f"feeder/{request.device_id}/control"
-
     payload = {
         "cmd": "water",
         "amount": request.amount,
         "unit": request.unit
     }
     
-    try:
-        mqtt_client.publish(topic, json.dumps(payload))
-        logger.info(f"Published to {topic}: {payload}")
-        return {"message": f"Water command sent to {request.device_id}", "data": payload}
-    except Exception as e:
-        logger.error(f"Failed to publish MQTT message: {e}")
-        raise HTTPException(status_code=500, detail="Failed to communicate with device")
+    with command_slot():
+        try:
+            position = submit_command(request.device_id, payload)
+            append_event("water", request.device_id, {
+                "amount": request.amount,
+                "unit": request.unit,
+                "queued": position > 0
+            })
+            if position:
+                return {"message": f"Water command queued for {request.device_id}", "queue_position": position, "data": payload}
+            return {"message": f"Water command sent to {request.device_id}", "data": payload}
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to publish MQTT message: {e}")
+            raise HTTPException(status_code=500, detail="Failed to communicate with device")
 
 @app.post("/chat")
 async def chat_with_ai(request: ChatRequest):
@@ -438,8 +1375,14 @@ async def chat_with_ai(request: ChatRequest):
             temperature=0.7
         )
         
-        prompt = f"You are a concise AI Pet Assistant. Context: {request.context}. User: {request.message}. Keep answer under 50 words."
-        response = model.generate_content(prompt, generation_config=generation_config)
+        context = request.context
+        feeding = pet_context(request.device_id) if request.device_id else ""
+        if feeding:
+            context = f"{context}. Feeding data: {feeding}" if context else f"Feeding data: {feeding}"
+
+        prompt = f"You are a concise AI Pet Assistant. Context: {context}. User: {request.message}. Keep answer under 50 words."
+        with timed_phase("ai_call"):
+            response = model.generate_content(prompt, generation_config=generation_config)
         return {"response": response.text}
     except Exception as e:
         logger.error(f"AI Error: {e}")
@@ -460,9 +1403,13 @@ async def generate_diet_plan(request: DietRequest):
             temperature=0.7
         )
 
+        feeding = pet_context(request.device_id) if request.device_id else ""
+        feeding_line = f"Current feeding (from the feeder): {feeding}. Adjust portions to it." if feeding else ""
+
         prompt = f"""
         Create a very brief daily diet plan for:
         {request.pet_name} ({request.species}, {request.breed}, {request.weight}kg, {request.age}yr).
+        {feeding_line}
         
         Format:
         - Morning: [Food]
@@ -470,21 +1417,26 @@ async def generate_diet_plan(request: DietRequest):
         - 1 Tip: [Tip]
         Max 50 words.
         """
-        response = model.generate_content(prompt, generation_config=generation_config)
+        with timed_phase("ai_call"):
+            response = model.generate_content(prompt, generation_config=generation_config)
         return {"plan": response.text}
     except Exception as e:
         logger.error(f"AI Error: {e}")
         raise HTTPException(status_code=500, detail=f"AI Error: {str(e)}")
 
 @app.get("/schedules")
-def get_schedules():
-    return load_schedules()
+def get_schedules(device_id: Optional[str] = None):
+    with schedule_lock:
+        if device_id:
+            return list(schedules_by_device.get(device_id, {}).values())
+        return list(schedule_registry.values())
 
 @app.post("/schedules")
 def add_schedule(request: ScheduleRequest):
     logger.info(f"Received schedule request: {request}")
     try:
-        hour, minute = map(int, request.time.split(':'))
+        time_str = normalize_time(request.time)
+        hour, minute = map(int, time_str.split(':'))
         job_id = str(uuid.uuid4())
         
         # Debug: Check time
@@ -503,14 +1455,15 @@ def add_schedule(request: ScheduleRequest):
         new_schedule = {
             "id": job_id,
             "device_id": request.device_id,
-            "time": request.time,
+            "time": time_str,
             "amount": request.amount,
             "unit": request.unit
         }
         
-        schedules = load_schedules()
-        schedules.append(new_schedule)
-        save_schedules(schedules)
+        with schedule_lock:
+            register_schedule(new_schedule)
+            save_schedules(list(schedule_registry.values()))
+        append_event("schedule_added", request.device_id, new_schedule)
         
         logger.info(f"Added schedule: {new_schedule}")
         return {"message": "Schedule added", "schedule": new_schedule}
@@ -527,8 +1480,378 @@ def delete_schedule(job_id: str):
     except:
         pass # Job might not exist in scheduler but exists in file
         
-    schedules = load_schedules()
-    schedules = [s for s in schedules if s['id'] != job_id]
-    save_schedules(schedules)
+    with schedule_lock:
+        removed = unregister_schedule(job_id)
+        save_schedules(list(schedule_registry.values()))
+    if removed:
+        append_event("schedule_deleted", removed["device_id"], {"id": job_id})
     
     return {"message": "Schedule deleted"}
+
+@app.get("/device/{device_id}/schedules")
+def get_device_schedules(device_id: str):
+    """
+    Effective schedules for a device, including its group's meal plan.
+    """
+    return {"schedules": device_schedules(device_id)}
+
+@app.get("/fleet/templates")
+def get_templates():
+    with fleet_lock:
+        return list(fleet["templates"].values())
+
+@app.post("/fleet/templates")
+def save_template(request: TemplateRequest, template_id: Optional[str] = None):
+    """
+    Creates a meal plan template, or replaces it when `template_id` is given.
+    """
+    try:
+        template = build_template(template_id or str(uuid.uuid4()), request.name, request.meals)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    with fleet_lock:
+        fleet["templates"][template["id"]] = template
+        rebuild_fleet_index()
+        save_fleet()
+    append_event("template_saved", None, template)
+    return {"message": "Template saved", "template": template}
+
+@app.delete("/fleet/templates/{template_id}")
+def delete_template(template_id: str):
+    with fleet_lock:
+        if groups_by_template.get(template_id):
+            raise HTTPException(status_code=409, detail="Template is used by a device group")
+        if fleet["templates"].pop(template_id, None) is None:
+            raise HTTPException(status_code=404, detail="Template not found")
+        rebuild_fleet_index()
+        save_fleet()
+    append_event("template_deleted", None, {"id": template_id})
+    return {"message": "Template deleted"}
+
+@app.get("/fleet/groups")
+def get_groups():
+    with fleet_lock:
+        return list(fleet["groups"].values())
+
+@app.post("/fleet/groups")
+def save_group(request: GroupRequest, group_id: Optional[str] = None):
+    """
+    Creates a device group on a meal plan, or replaces it when `group_id` is given.
+    Devices already in another group are moved.
+    """
+    with fleet_lock:
+        if request.template_id not in fleet["templates"]:
+            raise HTTPException(status_code=404, detail="Template not found")
+        group = {"id": group_id or str(uuid.uuid4()), "name": request.name, "template_id": request.template_id, "device_ids": []}
+        fleet["groups"][group["id"]] = group
+        assign_devices(fleet["groups"], group, request.device_ids, fleet["overrides"])
+        rebuild_fleet_index()
+        save_fleet()
+    append_event("group_saved", None, {"id": group["id"], "name": group["name"], "template_id": group["template_id"]})
+    return {"message": "Group saved", "group": group}
+
+@app.post("/fleet/groups/{group_id}/devices")
+def add_group_devices(group_id: str, request: GroupDevicesRequest):
+    with fleet_lock:
+        group = fleet["groups"].get(group_id)
+        if not group:
+            raise HTTPException(status_code=404, detail="Group not found")
+        assign_devices(fleet["groups"], group, request.device_ids, fleet["overrides"])
+        rebuild_fleet_index()
+        save_fleet()
+    append_event("group_devices_added", None, {"id": group_id, "device_ids": request.device_ids})
+    return {"message": "Devices added", "device_count": len(group["device_ids"])}
+
+@app.delete("/fleet/groups/{group_id}/devices/{device_id}")
+def remove_group_device(group_id: str, device_id: str):
+    with fleet_lock:
+        group = fleet["groups"].get(group_id)
+        if not group:
+            raise HTTPException(status_code=404, detail="Group not found")
+        group["device_ids"] = [d for d in group["device_ids"] if d != device_id]
+        rebuild_fleet_index()
+        save_fleet()
+    append_event("group_device_removed", device_id, {"id": group_id})
+    return {"message": "Device removed"}
+
+@app.delete("/fleet/groups/{group_id}")
+def delete_group(group_id: str):
+    with fleet_lock:
+        if fleet["groups"].pop(group_id, None) is None:
+            raise HTTPException(status_code=404, detail="Group not found")
+        rebuild_fleet_index()
+        save_fleet()
+    append_event("group_deleted", None, {"id": group_id})
+    return {"message": "Group deleted"}
+
+@app.put("/device/{device_id}/overrides")
+def set_device_overrides(device_id: str, meals: Dict[str, MealOverride]):
+    """
+    Per-device changes to its group's meal plan, keyed by meal time:
+    {"08:00": {"amount": 30}, "18:00": {"skip": true}}
+    Every time must match a meal in the plan. An empty body clears the overrides.
+    """
+    try:
+        override = build_override(meals)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    with fleet_lock:
+        unmatched = unmatched_override_times(override, fleet["groups"].get(device_group.get(device_id)), fleet["templates"])
+        if unmatched:
+            raise HTTPException(status_code=400, detail=f"No meal in {device_id}'s group plan at: {', '.join(unmatched)}")
+        if override:
+            fleet["overrides"][device_id] = override
+        else:
+            fleet["overrides"].pop(device_id, None)
+        save_fleet()
+    append_event("overrides_saved", device_id, override)
+    return {"message": "Overrides saved", "overrides": override}
+
+@app.get("/fleet/export")
+def export_fleet_schedules():
+    with fleet_lock:
+        return export_fleet()
+
+@app.post("/fleet/import")
+def import_fleet_schedules(request: FleetImportRequest):
+    """
+    Bulk import of templates, groups and overrides (the /fleet/export format).
+    Merges by id unless `replace` is set. Nothing is applied if any entry is invalid.
+    Imported overrides must match their device's plan; existing ones that no longer
+    do after the import are dropped.
+    """
+    try:
+        templates = {}
+        for t in request.templates:
+            template = build_template(t.id or str(uuid.uuid4()), t.name, t.meals)
+            templates[template["id"]] = template
+        overrides = {device_id: build_override(meals) for device_id, meals in request.overrides.items()}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    with fleet_lock:
+        staged = {
+            "templates": {} if request.replace else dict(fleet["templates"]),
+            "groups": {} if request.replace else {k: dict(g) for k, g in fleet["groups"].items()},
+            "overrides": {} if request.replace else dict(fleet["overrides"])
+        }
+        staged["templates"].update(templates)
+        for g in request.groups:
+            if g.template_id not in staged["templates"]:
+                raise HTTPException(status_code=400, detail=f"Unknown template {g.template_id} for group {g.name}")
+            group = {"id": g.id or str(uuid.uuid4()), "name": g.name, "template_id": g.template_id, "device_ids": []}
+            staged["groups"][group["id"]] = group
+            assign_devices(staged["groups"], group, g.device_ids, staged["overrides"])
+        staged["overrides"].update(overrides)
+
+        staged_device_group = {d: g for g in staged["groups"].values() for d in g["device_ids"]}
+        for device_id, override in overrides.items():
+            unmatched = unmatched_override_times(override, staged_device_group.get(device_id), staged["templates"])
+            if unmatched:
+                raise HTTPException(status_code=400, detail=f"No meal in {device_id}'s group plan at: {', '.join(unmatched)}")
+
+        fleet.update(staged)
+        rebuild_fleet_index()
+        save_fleet()
+    append_event("fleet_imported", None, {"templates": len(templates), "groups": len(request.groups), "overrides": len(overrides)})
+    return {"message": "Fleet imported", "templates": len(fleet["templates"]), "groups": len(fleet["groups"])}
+
+# Admin Diagnostics
+import marshal
+import secrets
+from fastapi import Depends, Header
+from fastapi.responses import Response
+
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL = 0.01  # 100 Hz
+profile_lock = threading.Lock()
+
+def require_admin(x_admin_token: str = Header(None)):
+    # Diagnostics must not show up in the slow-request log they are used to read
+    exclude_from_slow_log()
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=503, detail="Admin endpoints disabled (Missing ADMIN_TOKEN)")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+# Python-level leaves that mean a thread is blocked, not on CPU
+IDLE_LEAF_FUNCS = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("socket.py", "accept"),
+}
+
+def _thread_on_cpu(native_id):
+    # Linux scheduler state: "R" is running or runnable. Unknown counts as running.
+    try:
+        with open(f"/proc/self/task/{native_id}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] == "R"
+    except (OSError, IndexError):
+        return True
+
+def _is_idle(thread, stack):
+    filename, _, func = stack[-1]
+    if (os.path.basename(filename), func) in IDLE_LEAF_FUNCS:
+        return True
+    # Blocking C calls (select, sleep, lock waits) leave no Python frame of their own
+    return thread is not None and thread.native_id is not None and not _thread_on_cpu(thread.native_id)
+
+def sample_threads(seconds, interval=PROFILE_INTERVAL, idle=False):
+    """
+    Samples the stacks of every thread except the caller for `seconds`.
+    Unless `idle` is set, threads that are blocked (waiting on a queue, select,
+    sleep) are skipped so the output shows where CPU is spent.
+    Returns a Counter keyed by (thread_name, stack) and the measured
+    seconds per sample (sleep jitter makes it longer than `interval`).
+    """
+    own = threading.get_ident()
+    samples = Counter()
+    ticks = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        threads = {t.ident: t for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            thread = threads.get(ident)
+            stack = _stack_labels(frame)
+            if not idle and _is_idle(thread, stack):
+                continue
+            samples[(thread.name if thread else str(ident), stack)] += 1
+        ticks += 1
+        time.sleep(interval)
+    return samples, (time.perf_counter() - start) / max(ticks, 1)
+
+def samples_to_pstats(samples, interval=PROFILE_INTERVAL):
+    """
+    Converts stack samples into a marshalled stats dict loadable by pstats.Stats.
+    """
+    stats = {}
+    for (_, stack), count in samples.items():
+        seconds = count * interval
+        seen = set()
+        for i, func in enumerate(stack):
+            entry = stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+            if i == len(stack) - 1:
+                entry[2] += seconds
+            if func in seen:
+                continue
+            seen.add(func)
+            entry[0] += count
+            entry[1] += count
+            entry[3] += seconds
+            if i > 0:
+                nc, cc, tt, ct = entry[4].get(stack[i - 1], (0, 0, 0.0, 0.0))
+                leaf_time = seconds if i == len(stack) - 1 else 0.0
+                entry[4][stack[i - 1]] = (nc + count, cc + count, tt + leaf_time, ct + seconds)
+    return marshal.dumps({func: (cc, nc, tt, ct, callers) for func, (cc, nc, tt, ct, callers) in stats.items()})
+
+def classify_thread(thread):
+    name = thread.name
+    if thread is threading.main_thread():
+        return "event_loop"
+    if name.startswith("paho-mqtt"):
+        return "mqtt_loop"
+    if name == "APScheduler" or name.startswith("ThreadPoolExecutor"):
+        return "scheduler"
+    if name.startswith("AnyIO worker"):
+        return "uvicorn_worker"
+    if name in ("slow-request-watchdog",):
+        return "diagnostics"
+    return "other"
+
+def thread_cpu_seconds():
+    """
+    Per-thread user+system CPU time read from /proc (Linux only).
+    """
+    tick = os.sysconf("SC_CLK_TCK")
+    result = {}
+    for t in threading.enumerate():
+        try:
+            with open(f"/proc/self/task/{t.native_id}/stat") as f:
+                # Fields after the ")" of the comm field; utime/stime are 14th/15th overall
+                fields = f.read().rsplit(")", 1)[1].split()
+            result[t] = (int(fields[11]) + int(fields[12])) / tick
+        except (OSError, ValueError, IndexError):
+            continue
+    return result
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+def profile_cpu(seconds: float = 10, format: str = "collapsed", idle: bool = False):
+    """
+    Runs the sampling profiler for N seconds and returns a flamegraph
+    (collapsed stacks) or pstats file. Blocked threads are left out unless `idle`.
+    """
+    if format not in ("collapsed", "pstats"):
+        raise HTTPException(status_code=400, detail="Format must be 'collapsed' or 'pstats'")
+    if seconds <= 0 or seconds > PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"Seconds must be between 0 and {PROFILE_MAX_SECONDS}")
+    if not profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+
+    try:
+        logger.info(f"🔬 Profiling for {seconds}s ({format}, idle={idle})")
+        samples, interval = sample_threads(seconds, idle=idle)
+    finally:
+        profile_lock.release()
+
+    if format == "pstats":
+        return Response(
+            content=samples_to_pstats(samples, interval),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": 'attachment; filename="profile.pstats"'}
+        )
+    lines = [f"{_collapse(stack, prefix=thread)} {count}" for (thread, stack), count in samples.items()]
+    return Response(
+        content="\n".join(lines) + "\n",
+        media_type="text/plain",
+        headers={"Content-Disposition": 'attachment; filename="profile.folded"'}
+    )
+
+@app.get("/admin/slow-requests", dependencies=[Depends(require_admin)])
+def get_slow_requests():
+    """
+    Returns captured slow requests, newest first.
+    """
+    return {"threshold_ms": SLOW_REQUEST_MS, "requests": list(reversed(slow_requests))}
+
+@app.delete("/admin/slow-requests", dependencies=[Depends(require_admin)])
+def clear_slow_requests():
+    slow_requests.clear()
+    return {"message": "Slow request log cleared"}
+
+@app.get("/admin/threads", dependencies=[Depends(require_admin)])
+def get_thread_cpu(interval: float = 0):
+    """
+    Per-thread CPU attribution (paho loop, scheduler, uvicorn workers).
+    With interval > 0, also reports CPU % measured over that window.
+    """
+    if not os.path.exists("/proc/self/task"):
+        raise HTTPException(status_code=501, detail="Thread CPU stats require Linux /proc")
+    if interval < 0 or interval > 10:
+        raise HTTPException(status_code=400, detail="Interval must be between 0 and 10 seconds")
+
+    before = thread_cpu_seconds()
+    if interval > 0:
+        time.sleep(interval)
+        after = thread_cpu_seconds()
+    else:
+        after = before
+
+    threads = []
+    groups = {}
+    for t, cpu in after.items():
+        group = classify_thread(t)
+        entry = {"name": t.name, "group": group, "native_id": t.native_id, "cpu_seconds": round(cpu, 2)}
+        if interval > 0 and t in before:
+            entry["cpu_percent"] = round((cpu - before[t]) / interval * 100, 1)
+        threads.append(entry)
+        groups[group] = round(groups.get(group, 0) + cpu, 2)
+
+    threads.sort(key=lambda x: x["cpu_seconds"], reverse=True)
+    return {"groups": groups, "threads": threads}
@@ -1,7 +1,8 @@
-import React, { useState } from 'react';
+import React, { useState, useEffect } from 'react';
 import { View, Text, TouchableOpacity, ScrollView, TextInput, ActivityIndicator, KeyboardAvoidingView, Platform } from 'react-native';
 import { useRouter } from 'expo-router';
 import { ArrowLeft, Wand2, Utensils, MessageCircle, Send } from 'lucide-react-native';
+import AsyncStorage from '@react-native-async-storage/async-storage';
 import { styled } from 'nativewind';
 import { API_URL } from '../config';
 
@@ -24,6 +25,15 @@ export default function AICare() {
     ]);
     const [loadingChat, setLoadingChat] = useState(false);
 
+    // Feeder whose feeding history grounds the AI answers
+    const [deviceId, setDeviceId] = useState('');
+
+    useEffect(() => {
+        AsyncStorage.getItem('device_id')
+            .then(id => { if (id) setDeviceId(id); })
+            .catch(() => console.error('Failed to load settings'));
+    }, []);
+
     const generateDietPlan = async () => {
         if (!petName || !species || !weight || !age) {
             alert("Please fill in all details!");
@@ -40,7 +50,8 @@ export default function AICare() {
                     species,
                     breed,
                     weight: parseFloat(weight),
-                    age: parseFloat(age)
+                    age: parseFloat(age),
+                    device_id: deviceId || undefined
                 })
             });
             const data = await response.json();
@@ -71,7 +82,8 @@ export default function AICare() {
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
                     message: userMsg,
-                    context: `Pet: ${petName} (${species}), Weight: ${weight}kg, Age: ${age}`
+                    context: `Pet: ${petName} (${species}), Weight: ${weight}kg, Age: ${age}`,
+                    device_id: deviceId || undefined
                 })
             });
             const data = await response.json();